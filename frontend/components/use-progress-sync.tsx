@@ -28,6 +28,8 @@ interface UseProgressSyncReturn {
   syncFullProgress: (progress: any, studyItems: any) => void;
 }
 
+const textDecoder = new TextDecoder();
+
 // Generate a random anonymous username
 const generateUsername = () => {
   const adjectives = [
@@ -116,6 +118,8 @@ export function useProgressSync(courseId: string): UseProgressSyncReturn {
     try {
       const wsUrl = getWebSocketUrl();
       const ws = new WebSocket(`${wsUrl}/ws/${userId}`);
+      // Server sends pre-encoded JSON as binary frames
+      ws.binaryType = "arraybuffer";
       
       ws.onopen = () => {
         console.log("Connected to progress tracking server");
@@ -168,13 +172,21 @@ export function useProgressSync(courseId: string): UseProgressSyncReturn {
 
       ws.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data);
-          
-          if (data.type === "leaderboard_update" && data.courseId === courseId) {
-            setLeaderboard(data.leaderboard);
-          } else if (data.type === "connected") {
-            console.log("Server confirmed connection");
-          }
+          const raw = typeof event.data === "string"
+            ? event.data
+            : textDecoder.decode(event.data);
+          const data = JSON.parse(raw);
+
+          // Server coalesces queued messages into a single batch frame
+          const messages = data.type === "batch" ? data.items : [data];
+
+          messages.forEach((message: any) => {
+            if (message.type === "leaderboard_update" && message.courseId === courseId) {
+              setLeaderboard(message.leaderboard);
+            } else if (message.type === "connected") {
+              console.log("Server confirmed connection");
+            }
+          });
         } catch (error) {
           console.error("Error parsing WebSocket message:", error);
         }
@@ -3,12 +3,38 @@ Real-time progress tracking server using FastAPI and WebSockets
 Tracks anonymous users' progress across different courses and units
 """
 
+import asyncio
+import json
+import os
+import sys
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import islice
+from pathlib import Path
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Optional
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 from datetime import datetime
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Restore persisted progress, then keep flushing changes in the background
+    snapshots.load()
+    snapshot_task = asyncio.create_task(snapshots.run())
+    try:
+        yield
+    finally:
+        # Stop without cancelling, so an in-flight write runs to completion before the final flush
+        snapshots.stop()
+        await snapshot_task
+        await snapshots.flush()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -19,105 +45,561 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store active connections: {user_id: websocket}
-active_connections: Dict[str, WebSocket] = {}
 
-# Store user progress: {user_id: {courseId: {fileKey: bool}, username: str, lastUpdate: timestamp, study_items: {courseId: [fileKeys]}}}
-user_progress: Dict[str, dict] = {}
+@dataclass(slots=True)
+class UserState:
+    """One user's tracked progress; slotted to keep per-user memory small"""
+    username: str
+    # {courseId: {fileKey: bool}}
+    progress: Dict[str, Dict[str, bool]] = field(default_factory=dict)
+    # Epoch seconds of the last write
+    last_update: Optional[float] = field(default_factory=time.time)
+    # {courseId: frozenset(fileKeys)}
+    study_items: Dict[str, frozenset] = field(default_factory=dict)
+    # ISO form of last_update, formatted at most once per write
+    _last_update_iso: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    def touch(self):
+        """Record a write now; the ISO string is rebuilt lazily on the next leaderboard"""
+        self.last_update = time.time()
+        self._last_update_iso = None
+
+    def last_update_iso(self) -> str:
+        if self._last_update_iso is None:
+            self._last_update_iso = _format_timestamp(self.last_update)
+        return self._last_update_iso
+
+
+# Store user progress: {user_id: UserState}
+# Ordered least- to most-recently written so the oldest users can be evicted
+user_progress: "OrderedDict[str, UserState]" = OrderedDict()
+
+# Maximum number of users kept in memory before the least recently active are evicted
+MAX_USERS = 50_000
+
+
+# Maximum number of outbound messages buffered per client before it is dropped
+OUTBOUND_QUEUE_SIZE = 256
+
+# Limits on how many queued messages are coalesced into one batch frame
+MAX_BATCH_MESSAGES = 64
+MAX_BATCH_BYTES = 64 * 1024
+
+# Seconds to wait before broadcasting a changed leaderboard, so bursts of updates share one broadcast
+BROADCAST_DELAY = 0.05
+
+# Append-only journal of user state; one {"userId": ..., "state": {...} | null} record per line, last one wins
+SNAPSHOT_PATH = Path(os.environ.get("PROGRESS_SNAPSHOT_PATH") or Path(__file__).with_name("progress_snapshot.jsonl"))
+
+# Seconds between flushes of changed users to the journal
+SNAPSHOT_INTERVAL = 1.0
+
+# Rewrite the journal once it holds this many more records than there are users
+SNAPSHOT_COMPACT_SLACK = 10_000
+
+
+@dataclass
+class Conn:
+    """An accepted websocket plus its outbound queue and writer task"""
+    ws: WebSocket
+    out_queue: asyncio.Queue
+    writer_task: asyncio.Task
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        self.active_connections: Dict[str, Conn] = {}
+        # Per-course ranking kept sorted by _rank_key: {courseId: [(-percentage, -completed, userId, total)]}
+        self._leaderboards: Dict[str, List[Tuple[float, int, str, int]]] = {}
+        # {(courseId, userId): (completed, total)}
+        self._user_stats: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        # {userId: courseIds the user is ranked in}
+        self._ranked_courses: Dict[str, Set[str]] = {}
+        # Courses waiting for the next coalesced leaderboard broadcast
+        self._dirty_courses: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        # Connected users following each course (via study items or leaderboard requests) and the reverse index
+        self._course_subscribers: Dict[str, Set[str]] = {}
+        self._user_subscriptions: Dict[str, Set[str]] = {}
+        # {userId: courseIds subscribed via request_leaderboard}; these outlive study item changes
+        self._watched_courses: Dict[str, Set[str]] = {}
+        # Strong references to fire-and-forget tasks so they aren't garbage collected
+        self._background_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, user_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        
+        # Replace any stale connection for the same user
+        previous = self.active_connections.get(user_id)
+        if previous is not None:
+            previous.writer_task.cancel()
+        
+        queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        task = asyncio.create_task(self._writer(user_id, websocket, queue))
+        self.active_connections[user_id] = Conn(websocket, queue, task)
         
         # Initialize user progress if not exists
         if user_id not in user_progress:
-            user_progress[user_id] = {
-                "progress": {},
-                "username": "",
-                "lastUpdate": datetime.now().isoformat(),
-                "study_items": {}
-            }
-
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-
-    async def broadcast_leaderboard(self, course_id: str):
-        """Broadcast updated leaderboard to all connected users"""
+            user_progress[user_id] = UserState("")
+        self.touch_user(user_id)
+
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        """Drop a user's connection; if `websocket` is given, only when it is still the active one"""
+        conn = self.active_connections.get(user_id)
+        if conn is None or (websocket is not None and conn.ws is not websocket):
+            return
+        del self.active_connections[user_id]
+        conn.writer_task.cancel()
+        
+        self._watched_courses.pop(user_id, None)
+        for course_id in self._user_subscriptions.pop(user_id, ()):
+            self._remove_subscriber(course_id, user_id)
+
+    def subscribe(self, user_id: str, course_id: str, watching: bool = False):
+        """Record that a connected user is interested in a course's leaderboard.
+
+        `watching` marks subscriptions from leaderboard requests, which
+        unsubscribe() leaves alone.
+        """
+        if user_id not in self.active_connections:
+            return
+        self._course_subscribers.setdefault(course_id, set()).add(user_id)
+        self._user_subscriptions.setdefault(user_id, set()).add(course_id)
+        if watching:
+            self._watched_courses.setdefault(user_id, set()).add(course_id)
+
+    def unsubscribe(self, user_id: str, course_id: str):
+        """Drop a study-item subscription, unless the user also requested the course's leaderboard"""
+        if course_id in self._watched_courses.get(user_id, ()):
+            return
+        courses = self._user_subscriptions.get(user_id)
+        if courses is None or course_id not in courses:
+            return
+        courses.discard(course_id)
+        if not courses:
+            del self._user_subscriptions[user_id]
+        self._remove_subscriber(course_id, user_id)
+
+    def _remove_subscriber(self, course_id: str, user_id: str):
+        subscribers = self._course_subscribers.get(course_id)
+        if subscribers is not None:
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self._course_subscribers[course_id]
+
+    async def _writer(self, user_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Drain a client's outbound queue so slow peers never block producers.
+
+        Messages already waiting in the queue are coalesced into a single
+        `{"type": "batch", "items": [...]}` frame, capped by count and size.
+        """
+        carry: Optional[bytes] = None
+        try:
+            while True:
+                if carry is None:
+                    carry = _encode(await queue.get())
+                batch = [carry]
+                size = len(carry)
+                carry = None
+                
+                while len(batch) < MAX_BATCH_MESSAGES:
+                    try:
+                        encoded = _encode(queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                    if size + len(encoded) > MAX_BATCH_BYTES:
+                        carry = encoded
+                        break
+                    batch.append(encoded)
+                    size += len(encoded)
+                
+                # Each flush is one frame and one transport write. Both asyncio and uvloop
+                # already enable TCP_NODELAY on accepted sockets, so it goes out immediately
+                # and there is nothing left to gain from TCP_CORK.
+                if len(batch) == 1:
+                    await websocket.send_bytes(batch[0])
+                else:
+                    await websocket.send_bytes(b'{"type":"batch","items":[' + b",".join(batch) + b"]}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending to {user_id}: {e}")
+            self.disconnect(user_id, websocket)
+
+    def send(self, user_id: str, message: Union[dict, bytes]):
+        """Queue a message (a dict, or JSON already encoded) for one client; drop the client if it can't keep up"""
+        conn = self.active_connections.get(user_id)
+        if conn is None:
+            return
+        try:
+            conn.out_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            print(f"Outbound queue full for {user_id}, disconnecting")
+            self.disconnect(user_id)
+            # Close the socket too so the receive loop ends and the client reconnects
+            self._spawn(_close_quietly(conn.ws, 1013))
+
+    def _spawn(self, coro):
+        """Run a fire-and-forget coroutine, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def broadcast(self, message: dict, user_ids: Optional[Set[str]] = None):
+        """Queue a message for every connected client (or just `user_ids`), serializing it only once"""
+        encoded = _encode(message)
+        for user_id in list(self.active_connections if user_ids is None else user_ids):
+            self.send(user_id, encoded)
+
+    def leaderboard_changed(self, course_id: str):
+        """React to a change in a course's leaderboard.
+
+        Nothing is sent when no connected user follows the course; otherwise
+        the debounced broadcast reaches only the subscribers, which for a
+        solo user is just themselves.
+        """
+        if self._course_subscribers.get(course_id):
+            self.mark_dirty(course_id)
+
+    def mark_dirty(self, course_id: str):
+        """Schedule a leaderboard broadcast, coalescing bursts into one per BROADCAST_DELAY"""
+        self._dirty_courses.add(course_id)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after(BROADCAST_DELAY))
+
+    async def _flush_after(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._flush_task = None
+        
+        dirty, self._dirty_courses = self._dirty_courses, set()
+        for course_id in dirty:
+            self.broadcast_leaderboard(course_id)
+
+    def broadcast_leaderboard(self, course_id: str):
+        """Broadcast updated leaderboard to the connected users following the course"""
+        subscribers = self._course_subscribers.get(course_id)
+        if not subscribers:
+            return
         leaderboard = self.get_leaderboard(course_id)
-        message = {
+        self.broadcast({
             "type": "leaderboard_update",
             "courseId": course_id,
             "leaderboard": leaderboard
-        }
+        }, subscribers)
+
+    def refresh_user_course(self, user_id: str, course_id: str):
+        """Recount a user's completion for a course from scratch and re-rank them"""
+        data = user_progress.get(user_id)
+        study_items = data.study_items.get(course_id) if data is not None else None
         
-        disconnected = []
-        for user_id, websocket in self.active_connections.items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                print(f"Error sending to {user_id}: {e}")
-                disconnected.append(user_id)
+        # Only users who have items in their study bucket for this course are ranked
+        if not study_items:
+            self._set_stats(user_id, course_id, None)
+            return
         
-        # Clean up disconnected users
-        for user_id in disconnected:
-            self.disconnect(user_id)
+        # Calculate completion based ONLY on items in study bucket
+        course_progress = data.progress.get(course_id) or _EMPTY_PROGRESS
+        completed_count = sum(1 for file_key, done in course_progress.items() if done and file_key in study_items)
+        self._set_stats(user_id, course_id, (completed_count, len(study_items)))
+
+    def refresh_courses_in_background(self, user_id: str, course_ids: Set[str]):
+        """Recount and re-rank many courses off the websocket receive loop"""
+        self._spawn(self._refresh_courses(user_id, course_ids))
+
+    async def _refresh_courses(self, user_id: str, course_ids: Set[str]):
+        for course_id in course_ids:
+            self.refresh_user_course(user_id, course_id)
+            self.leaderboard_changed(course_id)
+            # Yield between courses so other clients keep being served
+            await asyncio.sleep(0)
+
+    def apply_progress_change(self, user_id: str, course_id: str, file_key: str, was_complete: bool, is_complete: bool):
+        """Adjust a user's completed count by one when a study item flips state"""
+        stats = self._user_stats.get((course_id, user_id))
+        if stats is None or bool(was_complete) == bool(is_complete):
+            return
+        if file_key not in user_progress[user_id].study_items.get(course_id, ()):
+            return
+        
+        completed_count, total_count = stats
+        completed_count += 1 if is_complete else -1
+        self._set_stats(user_id, course_id, (completed_count, total_count))
+
+    def forget_user(self, user_id: str):
+        """Remove a user from every leaderboard"""
+        for course_id in list(self._ranked_courses.get(user_id, ())):
+            self._set_stats(user_id, course_id, None)
 
-    def get_leaderboard(self, course_id: str):
-        """Generate leaderboard for a specific course"""
+    def reset_leaderboards(self):
+        self._leaderboards.clear()
+        self._user_stats.clear()
+        self._ranked_courses.clear()
+
+    def touch_user(self, user_id: str):
+        """Mark a user as most recently active and evict the oldest users over MAX_USERS"""
+        user_progress.move_to_end(user_id)
+        snapshots.mark_dirty(user_id)
+        
+        # Connected users are never evicted; rotate them to the end instead
+        for _ in range(len(user_progress) - MAX_USERS):
+            oldest = next(iter(user_progress))
+            if oldest in self.active_connections:
+                user_progress.move_to_end(oldest)
+                continue
+            del user_progress[oldest]
+            self.forget_user(oldest)
+            snapshots.mark_dirty(oldest)
+
+    def _set_stats(self, user_id: str, course_id: str, stats: Optional[Tuple[int, int]]):
+        """Replace a user's (completed, total) for a course, keeping the ranking sorted"""
+        key = (course_id, user_id)
+        ranking = self._leaderboards.setdefault(course_id, [])
+        
+        old_stats = self._user_stats.pop(key, None)
+        if old_stats is not None:
+            self._ranked_courses[user_id].discard(course_id)
+            old_rank_key = _rank_key(user_id, *old_stats)
+            index = bisect_left(ranking, old_rank_key)
+            if index < len(ranking) and ranking[index] == old_rank_key:
+                del ranking[index]
+        
+        if stats is not None:
+            self._user_stats[key] = stats
+            self._ranked_courses.setdefault(user_id, set()).add(course_id)
+            insort(ranking, _rank_key(user_id, *stats))
+        else:
+            if not ranking:
+                del self._leaderboards[course_id]
+            if not self._ranked_courses.get(user_id, True):
+                del self._ranked_courses[user_id]
+
+    def get_leaderboard(self, course_id: str, limit: Optional[int] = None):
+        """Generate leaderboard for a specific course, optionally only the top `limit` entries"""
         leaderboard = []
         
-        for user_id, data in user_progress.items():
-            # Get the list of study items (fileKeys) for this course
-            study_items = data.get("study_items", {}).get(course_id, [])
-            
-            # Only include users who have items in their study bucket for this course
-            if study_items:
-                course_progress = data.get("progress", {}).get(course_id, {})
-                
-                # Calculate completion based ONLY on items in study bucket
-                completed_count = sum(1 for file_key in study_items if course_progress.get(file_key, False))
-                total_count = len(study_items)
-                percentage = (completed_count / total_count * 100) if total_count > 0 else 0
-                
-                leaderboard.append({
-                    "userId": user_id,
-                    "username": data.get("username", "Anonymous"),
-                    "completed": completed_count,
-                    "total": total_count,
-                    "percentage": round(percentage, 1),
-                    "lastUpdate": data.get("lastUpdate", "")
-                })
+        # The ranking is already sorted, so the top-K is just a prefix
+        ranking = self._leaderboards.get(course_id, ())
+        if limit is not None:
+            ranking = islice(ranking, max(limit, 0))
         
-        # Sort by percentage (descending), then by completed count
-        leaderboard.sort(key=lambda x: (x["percentage"], x["completed"]), reverse=True)
+        for neg_percentage, neg_completed, user_id, total_count in ranking:
+            data = user_progress[user_id]
+            leaderboard.append({
+                "userId": user_id,
+                "username": data.username,
+                "completed": -neg_completed,
+                "total": total_count,
+                "percentage": -neg_percentage,
+                "lastUpdate": data.last_update_iso()
+            })
         
         return leaderboard
 
 
+async def _close_quietly(websocket: WebSocket, code: int = 1000):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
+
+# Shared stand-in for a course the user has no progress in yet; never mutated
+_EMPTY_PROGRESS: Dict[str, bool] = {}
+
+
+def _encode(message: Union[dict, bytes]) -> bytes:
+    """Serialize an outbound message to compact UTF-8 JSON unless it already is.
+
+    Frames go out as binary so the encoded bytes reach the transport without
+    being re-encoded per recipient.
+    """
+    if isinstance(message, bytes):
+        return message
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+def _format_timestamp(timestamp: Optional[float]) -> str:
+    """Format a stored epoch timestamp as ISO 8601"""
+    if timestamp is None:
+        return ""
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
+def _study_item_set(file_keys) -> frozenset:
+    """Store a course's study items as an interned set so lookups are O(1) and shared names are deduplicated"""
+    return frozenset(sys.intern(file_key) for file_key in file_keys)
+
+
+def _intern_progress(progress: Dict[str, Dict[str, bool]]) -> Dict[str, Dict[str, bool]]:
+    """Rebuild a {courseId: {fileKey: bool}} blob with interned file keys shared across users"""
+    intern = sys.intern
+    return {
+        course_id: {intern(file_key): done for file_key, done in course_progress.items()}
+        for course_id, course_progress in progress.items()
+    }
+
+
+def _rank_key(user_id: str, completed_count: int, total_count: int) -> Tuple[float, int, str, int]:
+    """Ascending sort key that orders by percentage, then completed count, both descending.
+
+    The total rides along at the end (user_id is unique, so it never affects
+    ordering) so leaderboard rows can be built from the tuple alone.
+    """
+    percentage = (completed_count / total_count * 100) if total_count > 0 else 0
+    return (-round(percentage, 1), -completed_count, user_id, total_count)
+
+
+class SnapshotWriter:
+    """Persists user_progress by periodically appending changed users to a journal file"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._dirty_users: Set[str] = set()
+        self._compact = False
+        self._records = 0
+        # Flushes run one at a time so writes to the journal and its tmp file never overlap
+        self._lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+
+    def mark_dirty(self, user_id: str):
+        self._dirty_users.add(user_id)
+
+    def mark_all_dirty(self):
+        """Rewrite the whole journal on the next flush"""
+        self._compact = True
+
+    def load(self):
+        """Restore user_progress and leaderboards from the journal, if one exists"""
+        if not self.path.exists():
+            return
+        
+        states: Dict[str, Optional[dict]] = {}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    continue
+                if not isinstance(record, dict) or not isinstance(record.get("userId"), str):
+                    continue
+                states.pop(record["userId"], None)
+                states[record["userId"]] = record.get("state")
+        
+        for user_id, record_state in states.items():
+            if not isinstance(record_state, dict):
+                continue
+            state = UserState(
+                username=record_state.get("username", "Anonymous"),
+                progress=_intern_progress(record_state.get("progress") or {}),
+                last_update=record_state.get("lastUpdate"),
+                study_items={
+                    course_id: _study_item_set(file_keys)
+                    for course_id, file_keys in (record_state.get("study_items") or {}).items()
+                },
+            )
+            user_progress[user_id] = state
+            for course_id in state.study_items:
+                manager.refresh_user_course(user_id, course_id)
+        
+        self.mark_all_dirty()
+        print(f"Restored progress for {len(user_progress)} users from {self.path}")
+
+    def stop(self):
+        """Ask run() to return after its current flush"""
+        self._stopping.set()
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), SNAPSHOT_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error writing progress snapshot: {e}")
+
+    async def flush(self):
+        """Write pending changes; serialization happens here, file I/O in a worker thread"""
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self):
+        if self._compact or self._records > len(user_progress) + SNAPSHOT_COMPACT_SLACK:
+            self._compact = False
+            self._dirty_users.clear()
+            lines = [_snapshot_record(user_id, state) for user_id, state in user_progress.items()]
+            try:
+                await asyncio.to_thread(_replace_lines, self.path, lines)
+            except Exception:
+                # Retry the full rewrite on the next flush
+                self._compact = True
+                raise
+            self._records = len(lines)
+        elif self._dirty_users:
+            dirty, self._dirty_users = self._dirty_users, set()
+            lines = [_snapshot_record(user_id, user_progress.get(user_id)) for user_id in dirty]
+            try:
+                await asyncio.to_thread(_append_lines, self.path, lines)
+            except Exception:
+                # Keep these users pending so the next flush writes them
+                self._dirty_users |= dirty
+                raise
+            self._records += len(lines)
+
+
+def _snapshot_record(user_id: str, state: Optional[UserState]) -> str:
+    record_state = None
+    if state is not None:
+        record_state = {
+            "progress": state.progress,
+            "username": state.username,
+            "lastUpdate": state.last_update,
+            "study_items": state.study_items,
+        }
+    # Study item frozensets are written as lists
+    return json.dumps({"userId": user_id, "state": record_state}, separators=(",", ":"), default=list) + "\n"
+
+
+def _append_lines(path: Path, lines: List[str]):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _replace_lines(path: Path, lines: List[str]):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 manager = ConnectionManager()
+snapshots = SnapshotWriter(SNAPSHOT_PATH)
 
 
 @app.get("/")
 async def root():
     return {
         "status": "online",
-        "active_users": len(active_connections),
+        "active_users": len(manager.active_connections),
         "total_users": len(user_progress)
     }
 
 
 @app.get("/leaderboard/{course_id}")
-async def get_leaderboard(course_id: str):
-    """Get leaderboard for a specific course"""
+async def get_leaderboard(course_id: str, limit: Optional[int] = None):
+    """Get leaderboard for a specific course (top `limit` entries if given)"""
     return {
         "courseId": course_id,
-        "leaderboard": manager.get_leaderboard(course_id)
+        "leaderboard": manager.get_leaderboard(course_id, limit)
     }
 
 
@@ -135,12 +617,14 @@ async def clear_progress(user_id: Optional[str] = None):
         if user_id in user_progress:
             del user_progress[user_id]
             removed = 1
+        manager.forget_user(user_id)
+        snapshots.mark_dirty(user_id)
 
         # Close and remove connection if present
         try:
             if user_id in manager.active_connections:
                 try:
-                    await manager.active_connections[user_id].close()
+                    await manager.active_connections[user_id].ws.close()
                 except Exception:
                     pass
                 manager.disconnect(user_id)
@@ -149,11 +633,7 @@ async def clear_progress(user_id: Optional[str] = None):
 
         # Notify remaining clients that a user's data was cleared
         msg = {"type": "progress_cleared", "scope": "user", "userId": user_id, "removed": removed}
-        for uid, ws in list(manager.active_connections.items()):
-            try:
-                await ws.send_json(msg)
-            except Exception:
-                manager.disconnect(uid)
+        manager.broadcast(msg)
 
         return {"status": "cleared_user", "userId": user_id, "removed": removed}
 
@@ -161,11 +641,13 @@ async def clear_progress(user_id: Optional[str] = None):
     else:
         removed = len(user_progress)
         user_progress.clear()
+        manager.reset_leaderboards()
+        snapshots.mark_all_dirty()
 
         # Close all active websocket connections
-        for uid, ws in list(manager.active_connections.items()):
+        for uid, conn in list(manager.active_connections.items()):
             try:
-                await ws.close()
+                await conn.ws.close()
             except Exception:
                 pass
             manager.disconnect(uid)
@@ -174,122 +656,183 @@ async def clear_progress(user_id: Optional[str] = None):
         return {"status": "cleared_all", "removed": removed}
 
 
+def _handle_progress_update(user_id: str, data: dict):
+    course_id = data["courseId"]
+    file_key = sys.intern(data["fileKey"])
+    is_complete = data["isComplete"]
+    username = data.get("username", "Anonymous")
+    
+    # Update user progress
+    user_state = user_progress.get(user_id)
+    if user_state is None:
+        user_state = user_progress[user_id] = UserState(username)
+    
+    course_progress = user_state.progress.setdefault(course_id, {})
+    was_complete = course_progress.get(file_key, False)
+    course_progress[file_key] = is_complete
+    user_state.username = username
+    user_state.touch()
+    manager.touch_user(user_id)
+    manager.apply_progress_change(user_id, course_id, file_key, was_complete, is_complete)
+    
+    # Broadcast updated leaderboard if anyone is following this course
+    manager.leaderboard_changed(course_id)
+    
+    # Send acknowledgment
+    manager.send(user_id, {
+        "type": "progress_ack",
+        "courseId": course_id,
+        "fileKey": file_key
+    })
+
+
+def _handle_request_leaderboard(user_id: str, data: dict):
+    course_id = data["courseId"]
+    manager.subscribe(user_id, course_id, watching=True)
+    # Only honour integer limits; anything else (strings, floats, bools) means the full board
+    limit = data.get("limit")
+    if type(limit) is not int:
+        limit = None
+    leaderboard = manager.get_leaderboard(course_id, limit)
+    manager.send(user_id, {
+        "type": "leaderboard_update",
+        "courseId": course_id,
+        "leaderboard": leaderboard
+    })
+
+
+def _handle_set_username(user_id: str, data: dict):
+    username = data["username"]
+    user_state = user_progress.get(user_id)
+    if user_state is not None:
+        user_state.username = username
+        snapshots.mark_dirty(user_id)
+        manager.send(user_id, {
+            "type": "username_updated",
+            "username": username
+        })
+
+
+def _handle_sync_study_items(user_id: str, data: dict):
+    course_id = data["courseId"]
+    file_keys = _study_item_set(data["fileKeys"])  # Set of fileKeys in study bucket
+    
+    user_state = user_progress.get(user_id)
+    if user_state is None:
+        user_state = user_progress[user_id] = UserState("Anonymous")
+    
+    user_state.study_items[course_id] = file_keys
+    user_state.touch()
+    manager.touch_user(user_id)
+    manager.refresh_user_course(user_id, course_id)
+    manager.subscribe(user_id, course_id)
+    
+    # Broadcast updated leaderboard with corrected percentages
+    manager.leaderboard_changed(course_id)
+    
+    manager.send(user_id, {
+        "type": "study_items_synced",
+        "courseId": course_id,
+        "count": len(file_keys)
+    })
+
+
+def _handle_sync_full_progress(user_id: str, data: dict):
+    # Bulk sync entire progress state from client's localStorage
+    full_progress = data["progress"]  # {courseId: {fileKey: bool}}
+    username = data.get("username", "Anonymous")
+    study_items = data.get("studyItems", {})
+    
+    user_state = user_progress.get(user_id)
+    if user_state is None:
+        user_state = user_progress[user_id] = UserState(username)
+    
+    previous_courses = set(user_state.study_items)
+    
+    # Merge/replace progress data from client (client is source of truth)
+    user_state.progress = _intern_progress(full_progress)
+    user_state.username = username
+    user_state.study_items = {
+        course_id: _study_item_set(file_keys) for course_id, file_keys in study_items.items()
+    }
+    user_state.touch()
+    manager.touch_user(user_id)
+    
+    affected_courses = set(full_progress.keys()) | set(study_items.keys())
+    for course_id in study_items:
+        manager.subscribe(user_id, course_id)
+    for course_id in previous_courses - set(study_items):
+        manager.unsubscribe(user_id, course_id)
+    
+    manager.send(user_id, {
+        "type": "full_progress_synced",
+        "coursesCount": len(affected_courses)
+    })
+    
+    # Re-rank and broadcast updated leaderboards for all affected courses in the background
+    manager.refresh_courses_in_background(user_id, affected_courses | previous_courses)
+
+
+# Client message type -> handler(user_id, data)
+HANDLERS: Dict[str, Callable[[str, dict], None]] = {
+    "progress_update": _handle_progress_update,
+    "request_leaderboard": _handle_request_leaderboard,
+    "set_username": _handle_set_username,
+    "sync_study_items": _handle_sync_study_items,
+    "sync_full_progress": _handle_sync_full_progress,
+}
+
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await manager.connect(user_id, websocket)
     
+    # Bind hot-loop lookups to locals once
+    receive = websocket.receive
+    loads = json.loads
+    get_handler = HANDLERS.get
+    
     try:
         # Send initial connection confirmation
-        await websocket.send_json({
+        manager.send(user_id, {
             "type": "connected",
             "userId": user_id,
             "message": "Connected to progress tracking server"
         })
         
         while True:
-            # Receive progress updates from client
-            data = await websocket.receive_json()
-            
-            if data["type"] == "progress_update":
-                course_id = data["courseId"]
-                file_key = data["fileKey"]
-                is_complete = data["isComplete"]
-                username = data.get("username", "Anonymous")
-                
-                # Update user progress
-                if user_id not in user_progress:
-                    user_progress[user_id] = {"progress": {}, "username": username}
-                
-                if course_id not in user_progress[user_id]["progress"]:
-                    user_progress[user_id]["progress"][course_id] = {}
-                
-                user_progress[user_id]["progress"][course_id][file_key] = is_complete
-                user_progress[user_id]["username"] = username
-                user_progress[user_id]["lastUpdate"] = datetime.now().isoformat()
-                
-                # Broadcast updated leaderboard to all users
-                await manager.broadcast_leaderboard(course_id)
-                
-                # Send acknowledgment
-                await websocket.send_json({
-                    "type": "progress_ack",
-                    "courseId": course_id,
-                    "fileKey": file_key
-                })
-            
-            elif data["type"] == "request_leaderboard":
-                course_id = data["courseId"]
-                leaderboard = manager.get_leaderboard(course_id)
-                await websocket.send_json({
-                    "type": "leaderboard_update",
-                    "courseId": course_id,
-                    "leaderboard": leaderboard
-                })
-            
-            elif data["type"] == "set_username":
-                username = data["username"]
-                if user_id in user_progress:
-                    user_progress[user_id]["username"] = username
-                    await websocket.send_json({
-                        "type": "username_updated",
-                        "username": username
-                    })
-            
-            elif data["type"] == "sync_study_items":
-                course_id = data["courseId"]
-                file_keys = data["fileKeys"]  # List of fileKeys in study bucket
-                
-                if user_id not in user_progress:
-                    user_progress[user_id] = {"progress": {}, "username": "Anonymous", "study_items": {}}
-                
-                if "study_items" not in user_progress[user_id]:
-                    user_progress[user_id]["study_items"] = {}
-                
-                user_progress[user_id]["study_items"][course_id] = file_keys
-                user_progress[user_id]["lastUpdate"] = datetime.now().isoformat()
-                
-                # Broadcast updated leaderboard with corrected percentages
-                await manager.broadcast_leaderboard(course_id)
-                
-                await websocket.send_json({
-                    "type": "study_items_synced",
-                    "courseId": course_id,
-                    "count": len(file_keys)
-                })
+            # Receive progress updates from client (text or binary frames)
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                data = loads(message.get("text") or message.get("bytes") or b"")
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                print(f"Ignoring malformed message from {user_id}")
+                continue
             
-            elif data["type"] == "sync_full_progress":
-                # Bulk sync entire progress state from client's localStorage
-                full_progress = data["progress"]  # {courseId: {fileKey: bool}}
-                username = data.get("username", "Anonymous")
-                study_items = data.get("studyItems", {})
-                
-                if user_id not in user_progress:
-                    user_progress[user_id] = {"progress": {}, "username": username, "study_items": {}}
-                
-                # Merge/replace progress data from client (client is source of truth)
-                user_progress[user_id]["progress"] = full_progress
-                user_progress[user_id]["username"] = username
-                user_progress[user_id]["study_items"] = study_items
-                user_progress[user_id]["lastUpdate"] = datetime.now().isoformat()
-                
-                # Broadcast updated leaderboards for all affected courses
-                affected_courses = set(full_progress.keys()) | set(study_items.keys())
-                for course_id in affected_courses:
-                    await manager.broadcast_leaderboard(course_id)
-                
-                await websocket.send_json({
-                    "type": "full_progress_synced",
-                    "coursesCount": len(affected_courses)
-                })
+            handler = get_handler(data.get("type"))
+            if handler is not None:
+                handler(user_id, data)
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, websocket)
         print(f"User {user_id} disconnected")
     except Exception as e:
         print(f"Error with user {user_id}: {e}")
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, websocket)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # loop/http stay on "auto", which picks uvloop and httptools where uvicorn[standard] installed them
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        ws="websockets",
+        ws_max_size=2**20,
+        log_level="warning",
+    )